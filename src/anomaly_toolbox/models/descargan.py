@@ -14,362 +14,778 @@
 
 """DeScarGAN models."""
 
-from abc import abstractmethod
-from typing import List
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Tuple, Union
 
 import tensorflow as tf
 import tensorflow.keras as k
 
 
+class ConvBNAct(k.layers.Layer):
+    """Conv2D -> BatchNormalization (optional) -> activation, as a single layer."""
+
+    def __init__(
+        self,
+        filters,
+        kernel_size,
+        strides,
+        groups,
+        kernel_initializer,
+        batch_norm,
+        momentum,
+        activation_layer,
+        **kwargs,
+    ):
+        """Create the layers.
+        Args:
+            filters: number of convolutional filters to learn (the depth of the output volume)
+            kernel_size: the size of the kernel to use
+            strides: the stride of the convolution.
+            groups: number of groups the input channels and the filters are split into.
+            kernel_initializer: the convolution kernel initializer.
+            batch_norm: enable/disable the batch normalization. When disabled the
+                        convolution uses a bias.
+            momentum: if batch norm is enabled, the momentum for this layer.
+            activation_layer: the activation function to use.
+            kwargs: forwarded to the keras Layer (e.g. input_shape, dtype). The dtype
+                    policy is used by the convolution and the batch normalization too.
+        """
+        super().__init__(**kwargs)
+        dtype = kwargs.get("dtype")
+        # The fused conv/BN kernels (and the TensorCore ones when using float16)
+        # are selected for the NHWC layout
+        self.conv = k.layers.Conv2D(
+            filters=filters,
+            kernel_size=kernel_size,
+            strides=strides,
+            padding="SAME",
+            data_format="channels_last",
+            groups=groups,
+            kernel_initializer=kernel_initializer,
+            bias_initializer="zeros",
+            use_bias=not batch_norm,
+            dtype=dtype,
+        )
+        self.bn = (
+            k.layers.BatchNormalization(
+                axis=-1, momentum=momentum, fused=True, dtype=dtype
+            )
+            if batch_norm
+            else None
+        )
+        self.act = activation_layer
+        # When False, in training the batch statistics are used without updating the
+        # moving ones (e.g. while the activations are recomputed in the backward pass)
+        self.update_moving_statistics = True
+
+    def call(self, inputs, training=False):
+        return self._normalize_and_activate(self.conv(inputs), training)
+
+    def _normalize_and_activate(self, hidden, training):
+        if self.bn is not None:
+            if training and not self.update_moving_statistics:
+                hidden = self._batch_normalize(hidden)
+            else:
+                hidden = self.bn(hidden, training=training)
+        return self.act(hidden)
+
+    def _batch_normalize(self, hidden):
+        """Normalize with the batch statistics, like the batch normalization in training,
+        without updating its moving statistics.
+        """
+        hidden_fp32 = tf.cast(hidden, tf.float32)
+        mean, variance = tf.nn.moments(hidden_fp32, axes=[0, 1, 2])
+        normalized = tf.nn.batch_normalization(
+            hidden_fp32, mean, variance, self.bn.beta, self.bn.gamma, self.bn.epsilon
+        )
+        return tf.cast(normalized, hidden.dtype)
+
+    def _bn_scale(self):
+        # BN(conv(x)) = gamma * (conv(x) - mean) / sqrt(var + eps) + beta
+        return self.bn.gamma * tf.math.rsqrt(self.bn.moving_variance + self.bn.epsilon)
+
+    def _to_conv_channels(self, values):
+        """Map per-channel batch normalization values to the conv output channels."""
+        return values
+
+    def fold_batch_norm(self):
+        """Absorb the batch normalization into the convolution kernel and bias,
+        and remove it. The layer must be built, the result is meant for inference only.
+        """
+        if self.bn is None:
+            return
+        scale = self._bn_scale()
+        shift = self.bn.beta - self.bn.moving_mean * scale
+        scale = self._to_conv_channels(scale)
+        kernel = self.conv.kernel * scale
+        bias = self._to_conv_channels(shift)
+        if self.conv.use_bias:
+            bias += self.conv.bias * scale
+
+        config = self.conv.get_config()
+        config.update(use_bias=True, name=f"{self.conv.name}_folded")
+        folded = k.layers.Conv2D.from_config(config)
+        folded.build((None, None, None, kernel.shape[2] * self.conv.groups))
+        folded.set_weights([kernel.numpy(), bias.numpy()])
+        self.conv = folded
+        self.bn = None
+
+
+class ClassConditionalConvBNAct(ConvBNAct):
+    """ConvBNAct conditioned on the class label.
+    Convolving the image concatenated with the (spatially constant) one-hot label
+    is equivalent, up to the border pixels, to convolving the image alone and adding
+    a bias that depends only on the class: the layer learns this per-class bias
+    directly.
+    """
+
+    def __init__(self, n_classes, filters, **kwargs):
+        """Create the layers and the per-class bias.
+        Args:
+            n_classes: the number of classes.
+            filters: number of convolutional filters to learn (the depth of the output volume)
+            kwargs: the other ConvBNAct arguments.
+        """
+        super().__init__(filters=filters, **kwargs)
+        self.class_bias = self.add_weight(
+            name="class_bias", shape=(n_classes, filters), initializer="zeros"
+        )
+
+    def call(self, inputs, training=False):
+        x, label = inputs
+        hidden = self.conv(x)
+        class_bias = tf.gather(self.class_bias, label)
+        hidden += tf.cast(class_bias, hidden.dtype)[:, tf.newaxis, tf.newaxis, :]
+        return self._normalize_and_activate(hidden, training)
+
+    def fold_batch_norm(self):
+        if self.bn is not None:
+            self.class_bias.assign(self.class_bias * self._bn_scale())
+        super().fold_batch_norm()
+
+
+class ConcatConvBNAct(ConvBNAct):
+    """ConvBNAct applied to the depth concatenation of two tensors, without
+    materializing the concatenation: conv([x; y], W) = conv(x, W_x) + conv(y, W_y).
+    """
+
+    def __init__(self, filters, kernel_size, kernel_initializer, **kwargs):
+        """Create the layers.
+        Args:
+            filters: number of convolutional filters to learn (the depth of the output volume)
+            kernel_size: the size of the kernel to use
+            kernel_initializer: the convolution kernel initializer.
+            kwargs: the other ConvBNAct arguments.
+        """
+        super().__init__(
+            filters=filters,
+            kernel_size=kernel_size,
+            kernel_initializer=kernel_initializer,
+            **kwargs,
+        )
+        # The bias (if any) is in self.conv
+        self.bypass_conv = k.layers.Conv2D(
+            filters=filters,
+            kernel_size=kernel_size,
+            strides=self.conv.strides,
+            padding="SAME",
+            data_format="channels_last",
+            kernel_initializer=kernel_initializer,
+            use_bias=False,
+            dtype=kwargs.get("dtype"),
+        )
+        self._kernel_initializer = kernel_initializer
+
+    def build(self, input_shape):
+        upsampled_shape, bypass_shape = input_shape
+        self.conv.build(upsampled_shape)
+        self.bypass_conv.build(bypass_shape)
+        # Initialize the kernel of the concatenated input and split it: the fan_in of
+        # both kernels is the one of the equivalent conv on the concatenation
+        kernel = k.initializers.get(self._kernel_initializer)(
+            self.conv.kernel.shape[:2]
+            + (self.conv.kernel.shape[2] + self.bypass_conv.kernel.shape[2],)
+            + self.conv.kernel.shape[3:],
+            dtype=self.conv.kernel.dtype,
+        )
+        upsampled_kernel, bypass_kernel = tf.split(
+            kernel,
+            [self.conv.kernel.shape[2], self.bypass_conv.kernel.shape[2]],
+            axis=2,
+        )
+        self.conv.kernel.assign(upsampled_kernel)
+        self.bypass_conv.kernel.assign(bypass_kernel)
+        super().build(input_shape)
+
+    def call(self, inputs, training=False):
+        upsampled, bypass = inputs
+        hidden = self.conv(upsampled) + self.bypass_conv(bypass)
+        return self._normalize_and_activate(hidden, training)
+
+    def fold_batch_norm(self):
+        if self.bn is not None:
+            self.bypass_conv.kernel.assign(self.bypass_conv.kernel * self._bn_scale())
+        super().fold_batch_norm()
+
+
+class SubPixelConvBNAct(ConvBNAct):
+    """Sub-pixel upsampling: Conv2D -> depth_to_space -> BatchNormalization -> activation.
+    The conv works at the input resolution with filters * block_size^2 outputs, that
+    are rearranged into a block_size times larger spatial grid with filters channels.
+    """
+
+    def __init__(self, filters, block_size, **kwargs):
+        """Create the layers.
+        Args:
+            filters: the depth of the output volume.
+            block_size: the upsampling factor.
+            kwargs: the other ConvBNAct arguments, except strides, groups and batch_norm.
+        """
+        super().__init__(
+            filters=filters * block_size ** 2,
+            strides=1,
+            groups=1,
+            batch_norm=True,
+            **kwargs,
+        )
+        self.block_size = block_size
+
+    def call(self, inputs, training=False):
+        hidden = tf.nn.depth_to_space(self.conv(inputs), self.block_size)
+        return self._normalize_and_activate(hidden, training)
+
+    def _to_conv_channels(self, values):
+        # depth_to_space moves the conv channel (i * block_size + j) * filters + c
+        # to the channel c of the (i, j) output pixel
+        return tf.tile(values, [self.block_size ** 2])
+
+
 class DeScarGANModel(k.Model):  # pylint: disable=too-many-ancestors
     """Methods shared across the DeScarGAN models."""
 
-    def __init__(self, batch_norm: bool):
+    def __init__(
+        self,
+        ill_label: int,
+        batch_norm: bool,
+        kernel_initializer: str,
+        mixed_precision: bool = False,
+        jit_compile: bool = False,
+    ):
         """Configure the layers.
         Args:
+            ill_label: the label of the anomalous class.
             batch_norm: enable/disable batch normalization in the network description.
+            kernel_initializer: the identifier of the convolutions kernel initializer.
+                                Every layer deserializes its own instance, while the bias
+                                initializer is always "zeros".
+            mixed_precision: when True, the layers use the "mixed_float16" dtype policy
+                             (the global policy is left untouched). The model outputs
+                             are kept in float32. NOTE: training in float16 requires
+                             loss scaling (k.mixed_precision.LossScaleOptimizer).
+            jit_compile: when True, the forward pass is compiled with XLA. XLA compiles
+                         it once per input shape: enable it only when the models are
+                         called with a fixed batch size (the trainer calls them on
+                         label-split sub-batches, whose size changes at every step).
         """
         super().__init__()
+        self._layer_policy = k.mixed_precision.Policy(
+            "mixed_float16" if mixed_precision else "float32"
+        )
+        self._jit_compile = jit_compile
+        self._compile_forward()
+        self._ill_label = tf.constant(ill_label, dtype=tf.int32)
         self._batch_norm = batch_norm
+        self._kernel_initializer = kernel_initializer
 
-        self._bias_initializer = None
-        self._kernel_initializer = None
-
-    @property
-    @abstractmethod
-    def kernel_initializer(self):
-        pass
-
-    @property
-    @abstractmethod
-    def bias_initializer(self):
-        pass
+    def _select_by_label(self, label, out_ill, out_healthy):
+        """Per-sample selection between the outputs of the ill and healthy heads.
+        Args:
+            label: the (N,) labels, of any numeric dtype.
+            out_ill: the (N, H, W, C) output of the ill head.
+            out_healthy: the (N, H, W, C) output of the healthy head.
+        Returns:
+            out_ill where label is the ill label, out_healthy elsewhere.
+        """
+        # tf.cast adds no op when label is already int32
+        is_ill = tf.equal(tf.cast(label, tf.int32), self._ill_label)
+        return tf.where(
+            is_ill[:, tf.newaxis, tf.newaxis, tf.newaxis], out_ill, out_healthy
+        )
 
     def conv(
         self,
-        input_shape,
         filters,
         kernel_size=3,
         momentum=0.01,
-        activation_layer=k.layers.ReLU(),
+        activation_layer=None,
+        groups=1,
+        strides=1,
+        input_shape=None,
     ):
         """Convolutional layer (with or without batch norm depending on the __init__).
         Args:
-            input_shape: layer input shape
             filters: number of convolutional filters to learn (the depth of the output volume)
             kernel_size: the size of the kernel to use
             momentum: if batch norm is enabled, the momentum for this layer.
-            activation_layer: the activation function to use.
+            activation_layer: the activation function to use, ReLU when None.
+            groups: number of groups the input channels and the filters are split
+                    into, each group is convolved independently.
+            strides: the stride of the convolution. With strides=2 the conv downsamples
+                     its output, in place of a separate 2x2 max pooling.
+            input_shape: layer input shape. Set it only on the first layer of a model,
+                         elsewhere it is unused.
         Returns:
-            The convolution operation correctly configured (as a keras model/layer).
+            The convolution operation correctly configured (as a ConvBNAct layer).
         """
-        return k.Sequential(
-            [
-                k.layers.Conv2D(
-                    input_shape=input_shape,
-                    filters=filters,
-                    kernel_size=kernel_size,
-                    padding="SAME",
-                    kernel_initializer=self.kernel_initializer,
-                    bias_initializer=self.bias_initializer,
-                    use_bias=not self._batch_norm,
-                ),
-            ]
-            + (
-                [k.layers.BatchNormalization(momentum=momentum)]
-                if self._batch_norm
-                else []
-            )
-            + [
-                activation_layer,
-            ]
+        layer_kwargs = {} if input_shape is None else {"input_shape": input_shape}
+        return ConvBNAct(
+            filters=filters,
+            kernel_size=kernel_size,
+            strides=strides,
+            groups=groups,
+            kernel_initializer=self._kernel_initializer,
+            batch_norm=self._batch_norm,
+            momentum=momentum,
+            activation_layer=activation_layer
+            or k.layers.ReLU(dtype=self._layer_policy),
+            dtype=self._layer_policy,
+            **layer_kwargs,
         )
 
-    @staticmethod
     def deconv(
-        input_shape,
+        self,
         filters,
-        use_upsample=True,
-        kernel_size=4,
+        kernel_size=3,
         strides=2,
-        padding="SAME",
         momentum=0.01,
-        activation_layer=k.layers.ReLU(),
+        activation_layer=None,
+        input_shape=None,
     ):
-        """DeConvolutional layer (with or without batch norm depending on the __init__).
+        """Sub-pixel deconvolutional layer (always with batch norm).
         Args:
-            input_shape: layer input shape
             filters: number of convolutional filters to learn (the depth of the output volume)
-            use_upsample: when True use the upsampling, otherwise conv2d transpose is used.
             kernel_size: the size of the kernel to use
-            strides: the stride to use when using conv2d transpose (use_upsample=False)
-            padidng: the padding to use when using conv2d transpose (use_upsample=False)
-            momentum: if batch norm is enabled, the momentum for this layer.
-            activation_layer: the activation function to use.
+            strides: the upsampling factor.
+            momentum: the batch norm momentum for this layer.
+            activation_layer: the activation function to use, ReLU when None.
+            input_shape: layer input shape. Set it only on the first layer of a model,
+                         elsewhere it is unused.
+        Returns:
+            The convolution operation correctly configured (as a SubPixelConvBNAct layer).
+        """
+        layer_kwargs = {} if input_shape is None else {"input_shape": input_shape}
+        return SubPixelConvBNAct(
+            filters=filters,
+            block_size=strides,
+            kernel_size=kernel_size,
+            kernel_initializer="glorot_uniform",
+            momentum=momentum,
+            activation_layer=activation_layer
+            or k.layers.ReLU(dtype=self._layer_policy),
+            dtype=self._layer_policy,
+            **layer_kwargs,
+        )
+
+    def fold_bn(self):
+        """Fold the batch normalization layers into the preceding convolutions.
+        The moving statistics and the affine parameters of every BatchNormalization
+        that follows a Conv2D (directly, or through the depth_to_space of the sub-pixel
+        convolutions) are absorbed into the convolution kernel and bias, and the
+        BatchNormalization layer is removed.
+        NOTE: the folded model is meant for inference only, call it after training.
+        """
+        for layer in list(self.submodules):
+            if isinstance(layer, ConvBNAct):
+                layer.fold_batch_norm()
+        # Drop the graphs traced with the unfolded layers
+        self._compile_forward()
+
+    def _compile_forward(self):
+        """Select the function executed by call.
+        This is the only place where the forward pass is wrapped in a tf.function: with
+        jit_compile, a new XLA compiled tf.function owned by this instance (and not
+        shared with the other instances of the class, nor with the traces of the
+        previous layers). Otherwise the forward pass runs as is, in the graph of the
+        caller.
+        """
+        self._forward_fn = (
+            tf.function(self._forward, jit_compile=True)
+            if self._jit_compile
+            else self._forward
+        )
+
+    def call(self, inputs: List[tf.Tensor], training=False):
+        return self._forward_fn(inputs, training=training)
+
+    def _forward(self, inputs: List[tf.Tensor], training=False):
+        """The forward pass of the model.
+        Args:
+            inputs: the [images, labels] batches.
+            training: the training flag to forward to the layers.
+        Returns:
+            The model outputs.
+        """
+        raise NotImplementedError
+
+    def _serving_function(self, input_shape: Tuple[int, int, int, int]):
+        """Concrete inference function with fully defined input shapes.
+        Args:
+            input_shape: the (N, H, W, C) shape of the images batch.
         Returns:
-            The convolution operation correctly configured (as a keras model/layer).
+            The concrete function of the model called with (images, labels) and
+            training=False.
         """
-        if use_upsample:
-            up_layer = k.Sequential(
-                [
-                    k.layers.UpSampling2D(),
-                    k.layers.Conv2D(
-                        input_shape=input_shape,
-                        filters=filters,
-                        kernel_size=3,
-                        strides=1,
-                        padding="SAME",
-                    ),
-                ]
+        # Trace the layers and not the XLA compiled call, so the graph optimizers
+        # of the inference runtimes can see (and fuse) every op
+        return tf.function(
+            lambda x, label: self._forward([x, label], training=False),
+            input_signature=[
+                tf.TensorSpec(input_shape, tf.float32, name="x"),
+                tf.TensorSpec(input_shape[:1], tf.int32, name="label"),
+            ],
+        ).get_concrete_function()
+
+    def export_trt(
+        self,
+        sample_input_shape: Tuple[int, int, int, int],
+        export_dir: Union[Path, str],
+        precision_mode: str = "FP16",
+        calibration_input_fn: Optional[Callable[[], Iterable]] = None,
+    ):
+        """Export the model as a TF-TRT SavedModel, for inference.
+        Conv/BN/activation chains are fused by TensorRT and an engine is built
+        for the fixed sample_input_shape.
+        Args:
+            sample_input_shape: the (N, H, W, C) shape of the images batch.
+            export_dir: where to save the converted SavedModel.
+            precision_mode: the TensorRT precision mode ("FP32", "FP16", "INT8").
+            calibration_input_fn: required when precision_mode is "INT8". A generator
+                                  function yielding (x, label) batches with
+                                  sample_input_shape (e.g. validation samples), used
+                                  to calibrate the INT8 activation ranges.
+        """
+        use_calibration = precision_mode == "INT8"
+        if use_calibration and calibration_input_fn is None:
+            raise ValueError("INT8 precision mode requires a calibration_input_fn")
+
+        serving_function = self._serving_function(sample_input_shape)
+        with tempfile.TemporaryDirectory() as saved_model_dir:
+            tf.saved_model.save(self, saved_model_dir, signatures=serving_function)
+            converter = tf.experimental.tensorrt.Converter(
+                input_saved_model_dir=saved_model_dir,
+                conversion_params=tf.experimental.tensorrt.ConversionParams(
+                    precision_mode=precision_mode, use_calibration=use_calibration
+                ),
             )
-        else:
-            up_layer = k.layers.Conv2DTranspose(
-                input_shape=input_shape,
-                filters=filters,
-                kernel_size=kernel_size,
-                strides=strides,
-                padding=padding,
+            converter.convert(
+                calibration_input_fn=calibration_input_fn if use_calibration else None
             )
 
-        return k.Sequential(
-            [
-                up_layer,
-                k.layers.BatchNormalization(momentum=momentum),
-                activation_layer,
-            ]
-        )
+            def input_fn():
+                yield (
+                    tf.zeros(sample_input_shape),
+                    tf.zeros(sample_input_shape[:1], dtype=tf.int32),
+                )
+
+            converter.build(input_fn=input_fn)
+            converter.save(str(export_dir))
 
-    @staticmethod
-    def concat(upsampled, bypass):
-        """Concatenate bypass and upsampled in the depth dimension.
+    def export_tflite(
+        self,
+        sample_input_shape: Tuple[int, int, int, int],
+        export_path: Union[Path, str],
+        representative_dataset: Optional[Callable[[], Iterable]] = None,
+    ):
+        """Export the model as a TFLite flatbuffer, for CPU inference.
+        The batch normalization layers are folded into the convolutions during the
+        conversion.
+        Args:
+            sample_input_shape: the (N, H, W, C) shape of the images batch.
+            export_path: the path of the .tflite file to write.
+            representative_dataset: a generator function yielding [x, label] batches
+                                    with sample_input_shape (e.g. validation samples).
+                                    When given, the model is fully quantized to INT8
+                                    (weights, activations and the float inputs/outputs,
+                                    the conversion fails if an op has no INT8 kernel).
+                                    Otherwise dynamic range quantization is used: only
+                                    the large enough weights are stored in INT8 and the
+                                    activations stay in float.
+        """
+        converter = tf.lite.TFLiteConverter.from_concrete_functions(
+            [self._serving_function(sample_input_shape)]
+        )
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if representative_dataset is not None:
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            converter.inference_input_type = tf.int8
+            converter.inference_output_type = tf.int8
+        Path(export_path).write_bytes(converter.convert())
+
+    def concat_conv(self, filters, kernel_size=3, momentum=0.01):
+        """Convolutional layer (with or without batch norm depending on the __init__)
+        applied to the depth concatenation of its two inputs (upsampled, bypass).
         Args:
-            upsampled: the input batch
-            bypass: the skip connection to concatenate
-        Return:
-            a new tensor with shape (N, H, W, C1 + C2)
+            filters: number of convolutional filters to learn (the depth of the output volume)
+            kernel_size: the size of the kernel to use
+            momentum: if batch norm is enabled, the momentum for this layer.
+        Returns:
+            The convolution operation correctly configured (as a ConcatConvBNAct layer).
         """
-        return tf.concat([upsampled, bypass], axis=-1)
+        return ConcatConvBNAct(
+            filters=filters,
+            kernel_size=kernel_size,
+            strides=1,
+            groups=1,
+            kernel_initializer=self._kernel_initializer,
+            batch_norm=self._batch_norm,
+            momentum=momentum,
+            activation_layer=k.layers.ReLU(dtype=self._layer_policy),
+            dtype=self._layer_policy,
+        )
 
 
 class Generator(DeScarGANModel):  # pylint: disable=too-many-ancestors
     """Image generator."""
 
-    def __init__(self, ill_label, n_channels=1, nf=64, batch_norm=True):
-        super().__init__(batch_norm)
+    def __init__(
+        self,
+        ill_label,
+        n_channels=1,
+        nf=64,
+        batch_norm=True,
+        mixed_precision=False,
+        conv_checkpointing=False,
+        jit_compile=False,
+    ):
+        """Configure the layers.
+        Args:
+            ill_label: the label of the anomalous class.
+            n_channels: number of channels of the input (and generated) images.
+            nf: number of filters of the first convolution, the deeper layers use multiples.
+            batch_norm: enable/disable batch normalization in the network description.
+            mixed_precision: when True, use the "mixed_float16" policy.
+            conv_checkpointing: when True, during training the activations inside the
+                                deepest encoder block and the decoder blocks are not
+                                stored but recomputed in the backward pass (less memory,
+                                more compute). Only the blocks outputs are kept.
+            jit_compile: when True, compile the forward pass with XLA.
+        """
+        # kaiming_normal_  in the paper -> HeNormal for keras.
+        # There are minor differences:
+        # https://stats.stackexchange.com/questions/484062/he-normal-keras-is-truncated-when-kaiming-normal-pytorch-is-not
+        super().__init__(
+            ill_label, batch_norm, "he_normal", mixed_precision, jit_compile
+        )
 
-        self._ill_label = tf.constant(ill_label, dtype=tf.int32)
+        self._conv_checkpointing = conv_checkpointing
         self._c_dim = 2
-        self._max_pool_fn = k.layers.MaxPool2D
 
-        self._down0 = k.Sequential(
-            [
-                self.conv((None, None, n_channels + self._c_dim), nf),
-                self.conv((None, None, nf), nf),
-            ]
+        # The label conditioning is a learned per-class bias of the first conv,
+        # instead of tiling the one-hot label to H x W and concatenating it to the input
+        self._conv0 = ClassConditionalConvBNAct(
+            n_classes=self._c_dim,
+            filters=nf,
+            kernel_size=3,
+            strides=1,
+            groups=1,
+            kernel_initializer=self._kernel_initializer,
+            batch_norm=self._batch_norm,
+            momentum=0.01,
+            activation_layer=k.layers.ReLU(dtype=self._layer_policy),
+            dtype=self._layer_policy,
         )
+        self._down0 = self.conv(nf)
         self._down1 = k.Sequential(
             [
-                self._max_pool_fn(),
-                self.conv((None, None, nf), nf * 2),
-                self.conv((None, None, nf * 2), nf * 2),
+                self.conv(nf * 2, strides=2),
+                self.conv(nf * 2),
             ]
         )
         self._down2 = k.Sequential(
             [
-                self._max_pool_fn(),
-                self.conv((None, None, nf * 2), nf * 4),
-                self.conv((None, None, nf * 4), nf * 4),
+                self.conv(nf * 4, strides=2),
+                self.conv(nf * 4),
             ]
         )
         self._down3 = k.Sequential(
             [
-                self._max_pool_fn(),
-                self.conv((None, None, nf * 4), nf * 8),
-                self.conv((None, None, nf * 8), nf * 8),
+                self.conv(nf * 8, strides=2),
+                self.conv(nf * 8),
             ]
         )
 
-        self._up3 = self.deconv((None, None, nf * 8), nf * 4)
+        self._up3 = self.deconv(nf * 4)
 
-        self._conv5 = k.Sequential(
-            [
-                self.conv((None, None, nf * 8), nf * 4),
-                self.conv((None, None, nf * 4), nf * 4),
-            ]
-        )
+        # The first conv of the decoder blocks reads the upsampled tensor and the skip
+        # connection without concatenating them
+        self._conv5_fused = self.concat_conv(nf * 4)
+        self._conv5 = self.conv(nf * 4)
 
-        self._up2 = self.deconv((None, None, nf * 4), nf * 2)
+        self._up2 = self.deconv(nf * 2)
 
-        self._conv6 = k.Sequential(
-            [
-                self.conv((None, None, nf * 4), nf * 2),
-                self.conv((None, None, nf * 2), nf * 2),
-            ]
-        )
+        self._conv6_fused = self.concat_conv(nf * 2)
+        self._conv6 = self.conv(nf * 2)
 
-        self._up1 = self.deconv((None, None, nf * 2), nf)
+        self._up1 = self.deconv(nf)
 
-        self._conv7_ill = k.Sequential(
+        # The ill and healthy heads are a single stack: the first conv learns the
+        # filters of both heads, the grouped output conv keeps them independent.
+        # Output channels [:n_channels] are the ill head, the others the healthy one.
+        self._conv7 = k.Sequential(
             [
-                self.conv((None, None, nf), nf),
+                self.conv(nf * 2),
                 self.conv(
-                    (None, None, nf),
-                    n_channels,
-                    activation_layer=k.layers.Activation("tanh"),
-                ),
-            ]
-        )
-        self._conv7_healthy = k.Sequential(
-            [
-                self.conv((None, None, nf), nf),
-                self.conv(
-                    (None, None, nf),
-                    n_channels,
-                    activation_layer=k.layers.Activation("tanh"),
+                    n_channels * 2,
+                    activation_layer=k.layers.Activation("tanh", dtype="float32"),
+                    groups=2,
                 ),
             ]
         )
 
-    @property
-    def kernel_initializer(self):
-        """kaiming_normal_  in the paper -> HeNormal for keras.
-        There are minor differences:
-        https://stats.stackexchange.com/questions/484062/he-normal-keras-is-truncated-when-kaiming-normal-pytorch-is-not
+    def _maybe_recompute(self, blocks, inputs, training):
+        """Execute the blocks in sequence, recomputing their activations in the
+        backward pass when the conv checkpointing is enabled and the model is training.
+        Args:
+            blocks: the layers/models to execute.
+            inputs: the input tensor of the first block, or the list of its input tensors.
+            training: the training flag to forward to the blocks.
+        Returns:
+            The output of the last block.
         """
-        if not self._kernel_initializer:
-            self._kernel_initializer = k.initializers.HeNormal()
-        return self._kernel_initializer
-
-    @property
-    def bias_initializer(self):
-        """Zero initializer."""
-        if not self._bias_initializer:
-            self._bias_initializer = k.initializers.Zeros()
-        return self._bias_initializer
-
-    def call(self, inputs: List[tf.Tensor], training=False):
+        conv_layers = [
+            layer
+            for block in blocks
+            for layer in [block, *block.submodules]
+            if isinstance(layer, ConvBNAct)
+        ]
+        executions = []
+
+        def forward(*tensors):
+            # tf.recompute_grad executes forward again in the backward pass: only the
+            # first execution updates the moving statistics of the batch norms
+            for layer in conv_layers:
+                layer.update_moving_statistics = not executions
+            executions.append(True)
+            try:
+                hidden = list(tensors) if len(tensors) > 1 else tensors[0]
+                for block in blocks:
+                    hidden = block(hidden, training=training)
+            finally:
+                for layer in conv_layers:
+                    layer.update_moving_statistics = True
+            return hidden
+
+        tensors = inputs if isinstance(inputs, list) else [inputs]
+        if self._conv_checkpointing and training:
+            return tf.recompute_grad(forward)(*tensors)
+        return forward(*tensors)
+
+    def _forward(self, inputs: List[tf.Tensor], training=False):
         x, label = inputs
-        one_hot_label = tf.one_hot(label, depth=2, dtype=tf.float32)
-        condition = tf.tile(
-            one_hot_label[:, tf.newaxis, tf.newaxis, :],
-            [1, tf.shape(x)[1], tf.shape(x)[2], 1],
-        )
-        x = tf.concat([x, condition], axis=-1)
-
-        input_0 = self._down0(x, training=training)
+        label = tf.cast(label, tf.int32)
+        hidden = self._conv0([x, label], training=training)
+        input_0 = self._down0(hidden, training=training)
         input_1 = self._down1(input_0, training=training)
         input_2 = self._down2(input_1, training=training)
-        input_3 = self._down3(input_2, training=training)
+        input_3 = self._maybe_recompute([self._down3], input_2, training)
 
         input_upsampled_3 = self._up3(input_3, training=training)
-        cat3 = self.concat(input_upsampled_3, input_2)
-        input_5 = self._conv5(cat3, training=training)
+        input_5 = self._maybe_recompute(
+            [self._conv5_fused, self._conv5], [input_upsampled_3, input_2], training
+        )
         input_upsampled_2 = self._up2(input_5, training=training)
-        cat2 = self.concat(input_upsampled_2, input_1)
 
-        input_6 = self._conv6(cat2, training=training)
+        input_6 = self._maybe_recompute(
+            [self._conv6_fused, self._conv6], [input_upsampled_2, input_1], training
+        )
         input_upsampled_1 = self._up1(input_6, training=training)
 
-        return tf.cond(
-            tf.reduce_all(tf.equal(self._ill_label, tf.cast(label, tf.int32))),
-            lambda: self._conv7_ill(input_upsampled_1),
-            lambda: self._conv7_healthy(input_upsampled_1),
+        # Both heads are executed and the output is selected per-sample, no control
+        # flow in the graph (XLA can compile and fuse the whole forward pass)
+        out_ill, out_healthy = tf.split(
+            self._maybe_recompute([self._conv7], input_upsampled_1, training),
+            2,
+            axis=-1,
         )
+        return self._select_by_label(label, out_ill, out_healthy)
 
 
 class Discriminator(DeScarGANModel):  # pylint: disable=too-many-ancestors
     """Image discriminator."""
 
-    def __init__(self, ill_label, n_channels=1, nf=64, batch_norm=True):
-        super().__init__(batch_norm)
-
-        self._ill_label = tf.constant(ill_label, dtype=tf.int32)
-        self._max_pool_fn = k.layers.MaxPool2D
+    def __init__(
+        self,
+        ill_label,
+        n_channels=1,
+        nf=64,
+        batch_norm=True,
+        mixed_precision=False,
+        jit_compile=False,
+    ):
+        # Xavier normal
+        super().__init__(
+            ill_label, batch_norm, "glorot_normal", mixed_precision, jit_compile
+        )
 
         self._encoder = k.Sequential(
             [
-                self.conv((None, None, n_channels), nf),
-                self._max_pool_fn(),
-                self.conv((None, None, nf), nf * 2),
-                self._max_pool_fn(),
-                self.conv((None, None, nf * 2), nf * 4),
-                self.conv((None, None, nf * 4), nf * 4),
-                self._max_pool_fn(),
-                self.conv((None, None, nf * 4), nf * 8),
-                self.conv((None, None, nf * 8), nf * 8),
-                self._max_pool_fn(),
-                self.conv((None, None, nf * 8), nf * 8),
-                self.conv((None, None, nf * 8), nf * 8),
-                self._max_pool_fn(),
-                self.conv((None, None, nf * 8), nf * 16),
+                self.conv(nf, strides=2, input_shape=(None, None, n_channels)),
+                self.conv(nf * 2, strides=2),
+                self.conv(nf * 4),
+                self.conv(nf * 4, strides=2),
+                self.conv(nf * 8),
+                self.conv(nf * 8, strides=2),
+                self.conv(nf * 8),
+                self.conv(nf * 8, strides=2),
+                self.conv(nf * 16),
             ]
         )
 
-        self._conv_ill = k.Sequential(
-            [
-                self.conv((None, None, nf * 16), nf * 16),
-                self.conv((None, None, nf * 16), nf * 16),
-                self.conv(
-                    (None, None, nf * 16),
-                    1,
-                    kernel_size=1,
-                    activation_layer=k.layers.Activation("linear"),
-                ),
-            ]
-        )
-        self._conv_healthy = k.Sequential(
+        # The ill and healthy heads are a single stack: the first conv learns the
+        # filters of both heads, the grouped convs keep them independent.
+        # Output channel 0 is the ill head, channel 1 the healthy one.
+        self._conv_heads = k.Sequential(
             [
-                self.conv((None, None, nf * 16), nf * 16),
-                self.conv((None, None, nf * 16), nf * 16),
+                self.conv(nf * 32),
+                self.conv(nf * 32, groups=2),
                 self.conv(
-                    (None, None, nf * 16),
-                    1,
+                    2,
                     kernel_size=1,
-                    activation_layer=k.layers.Activation("linear"),
+                    activation_layer=k.layers.Activation("linear", dtype="float32"),
+                    groups=2,
                 ),
             ]
         )
 
         self._conv2 = k.Sequential(
             [
-                self.conv((None, None, nf * 16), nf * 16),
-                self.conv((None, None, nf * 16), nf * 16),
-                self._max_pool_fn(),
+                self.conv(nf * 16),
+                self.conv(nf * 16, strides=2),
             ]
         )
 
+        # Global pooling makes the classifier independent from the spatial size of
+        # the last feature map (no (nf * 16 * H * W, 64) weight matrix)
         self._linearclass = k.Sequential(
             [
-                k.layers.Flatten(),
-                k.layers.Dense(64),
-                k.layers.ReLU(),
-                k.layers.Dropout(0.1),
-                k.layers.Dense(2),
+                k.layers.GlobalAveragePooling2D(
+                    data_format="channels_last", dtype=self._layer_policy
+                ),
+                k.layers.Dense(64, activation="relu", dtype=self._layer_policy),
+                k.layers.Dropout(0.1, dtype=self._layer_policy),
+                k.layers.Dense(2, dtype="float32"),
             ]
         )
 
-    @property
-    def kernel_initializer(self):
-        """Xavier normal"""
-        if not self._kernel_initializer:
-            self._kernel_initializer = k.initializers.GlorotNormal()
-        return self._kernel_initializer
-
-    @property
-    def bias_initializer(self):
-        """Zero initializer."""
-        if not self._bias_initializer:
-            self._bias_initializer = k.initializers.Zeros()
-        return self._bias_initializer
-
-    def call(self, inputs: List[tf.Tensor], training=False):
+    def _forward(self, inputs: List[tf.Tensor], training=False):
         x, label = inputs
         hidden = self._encoder(x, training=training)
-        out = tf.cond(
-            tf.reduce_all(tf.equal(self._ill_label, tf.cast(label, tf.int32))),
-            lambda: self._conv_ill(hidden, training=training),
-            lambda: self._conv_healthy(hidden, training=training),
+        out_ill, out_healthy = tf.split(
+            self._conv_heads(hidden, training=training), 2, axis=-1
         )
+        out = self._select_by_label(label, out_ill, out_healthy)
         conv = self._conv2(hidden, training=training)
-        pred = self._linearclass(tf.squeeze(conv, axis=[1, 2]), training=training)
+        pred = self._linearclass(conv, training=training)
         return out, pred
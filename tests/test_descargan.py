@@ -0,0 +1,66 @@
+# Copyright 2021 Zuru Tech HK Limited. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the DeScarGAN models."""
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from anomaly_toolbox.models.descargan import Generator
+
+
+def _moving_statistics(model):
+    return [variable.numpy() for variable in model.non_trainable_variables]
+
+
+@pytest.mark.parametrize("graph", [False, True])
+def test_conv_checkpointing_updates_moving_statistics_once(graph):
+    """The backward pass of the checkpointed generator recomputes the activations
+    without updating the batch norm moving statistics a second time."""
+    x = tf.random.uniform((4, 16, 16, 1))
+    label = tf.constant([0, 1, 0, 1])
+    reference = Generator(ill_label=1, nf=4)
+    checkpointed = Generator(ill_label=1, nf=4, conv_checkpointing=True)
+    reference([x, label])
+    checkpointed([x, label])
+    checkpointed.set_weights(reference.get_weights())
+
+    def forward(model):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(model([x, label], training=True))
+        return tape, loss
+
+    def step(model):
+        tape, loss = forward(model)
+        after_forward = [tf.identity(v) for v in model.non_trainable_variables]
+        gradients = tape.gradient(loss, model.trainable_variables)
+        return after_forward, [tf.convert_to_tensor(g) for g in gradients]
+
+    if graph:
+        step = tf.function(step)
+
+    after_forward, gradients = step(checkpointed)
+    _, gradients_ref = step(reference)
+
+    # The backward pass leaves the moving statistics unchanged
+    for expected, actual in zip(after_forward, _moving_statistics(checkpointed)):
+        np.testing.assert_array_equal(expected, actual)
+    # and the forward pass updated them like without checkpointing
+    for expected, actual in zip(
+        _moving_statistics(reference), _moving_statistics(checkpointed)
+    ):
+        np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-5)
+    for expected, actual in zip(gradients_ref, gradients):
+        np.testing.assert_allclose(expected, actual, rtol=1e-3, atol=1e-4)